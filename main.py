@@ -28,8 +28,8 @@ if __name__ == "__main__":
 
     deep_search = DeepSearch(api_key, mode=args.mode)
 
-    breadth_and_depth = deep_search.determine_research_breadth_and_depth(
-        args.query)
+    breadth_and_depth = asyncio.run(
+        deep_search.determine_research_breadth_and_depth(args.query))
 
     breadth = breadth_and_depth["breadth"]
     depth = breadth_and_depth["depth"]
@@ -41,7 +41,8 @@ if __name__ == "__main__":
 
     print("To better understand your research needs, please answer these follow-up questions:")
 
-    follow_up_questions = deep_search.generate_follow_up_questions(args.query)
+    follow_up_questions = asyncio.run(
+        deep_search.generate_follow_up_questions(args.query))
 
     # get answers to the follow up questions
     answers = []
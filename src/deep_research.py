@@ -1,20 +1,227 @@
 import asyncio
+from collections import OrderedDict
+from operator import itemgetter
 import datetime
-import json
+import functools
+import hashlib
+import itertools
 import os
+from pathlib import Path
+import random
+import sqlite3
+import string
+import sys
 from typing import List
 import uuid
 import argparse
 import time
 import math
 
+import orjson
 from dotenv import load_dotenv
 
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 from pydantic import BaseModel
 
 
+_PROMPT_RESEARCH_PARAMETERS = """
+        Analyze this research query and determine the appropriate breadth (number of parallel search queries) 
+        and depth (levels of follow-up questions) needed for thorough research:
+
+        Query: {query}
+
+        Consider:
+        1. Complexity of the topic
+        2. Breadth of knowledge required
+        3. Depth of expertise needed
+        4. Potential for follow-up exploration
+
+        Return a JSON object with:
+        - "breadth": integer between 1-10 (number of parallel search queries)
+        - "depth": integer between 1-5 (levels of follow-up questions)
+        - "explanation": brief explanation of your reasoning
+        """
+
+_PROMPT_FOLLOW_UP_QUESTIONS = """
+        Based on the following user query, generate {max_questions} follow-up questions that would help clarify what the user wants to know.
+		These questions should:
+		1. Seek to understand the user's specific information needs
+		2. Clarify ambiguous terms or concepts in the original query
+		3. Determine the scope or boundaries of what the user is looking for
+		4. Identify the user's level of familiarity with the topic
+		5. Uncover the user's purpose or goal for seeking this information
+
+		User Query: {query}
+
+		Format your response as a JSON object with a single key "follow_up_queries" containing an array of strings.
+		Example:
+		```json
+		{{
+			"follow_up_queries": [
+				"Could you specify what aspects of electric vehicles you're most interested in learning about?",
+				"Are you looking for information about a specific brand or type of electric vehicle?",
+				"Would you like to know about the technical details, environmental impact, or consumer aspects?"
+			]
+		}}
+		```
+        """
+
+_PROMPT_GENERATE_QUERIES = """
+        You are a research assistant helping to explore the topic: "{query}"
+        
+        {mode_prompt}.
+        {learnings_section}
+        {previous_queries_section}
+        
+        Generate {num_queries} specific search queries that would help gather comprehensive information about this topic.
+        Each query should focus on a different aspect or subtopic.
+        Make the queries specific and well-formed for a search engine.
+        
+        Format your response as a JSON object with a "queries" field containing an array of query strings.
+        """
+
+_PROMPT_PROCESS_RESULT = """
+        Analyze the following search results for the query: "{query}"
+        
+        Search Results:
+        {result}
+        
+        Please extract:
+        1. The {num_learnings} most important learnings or insights from these results
+        2. {num_follow_up_questions} follow-up questions that would help explore this topic further
+        
+        Format your response as a JSON object with:
+        - "learnings": array of learning strings
+        - "follow_up_questions": array of question strings
+        """
+
+_PROMPT_CLUSTER_QUERIES = """
+        Group the following search queries so that queries which are semantically similar
+        (would likely return similar search results) end up in the same group:
+
+        {queries_text}
+
+        Return a JSON object with a single field "clusters": an array of groups, where each group
+        is an array of query numbers. Every query number must appear in exactly one group;
+        queries that are not similar to any other query go in a group of their own.
+        """
+
+_PROMPT_FINAL_REPORT = """
+		You are a creative storyteller tasked with transforming research into an engaging and distinctive report.
+
+        Research Query: {query}
+
+        Key Discoveries:
+        {learnings_text}
+
+        Craft a captivating report that:
+
+        # CREATIVE APPROACH
+        1. Opens with an imaginative introduction that draws readers into the topic
+        2. Transforms key discoveries into a compelling narrative with your unique voice
+        3. Adds fresh perspectives and unexpected connections between ideas
+        4. Experiments freely with tone, style, and expression
+        5. Concludes with thought-provoking reflections that linger with the reader
+
+        # FORMATTING TOOLS
+        - Create evocative, imaginative headings
+        - Use markdown formatting (##, ###, **bold**, *italics*) for visual interest
+        - Incorporate blockquotes for emphasis or contrast
+        - Deploy bullet points or numbered lists where they enhance clarity
+        - Insert tables to organize information in visually appealing ways
+        - Use horizontal rules (---) to create dramatic pauses or section breaks
+
+        Feel free to be bold, experimental, and expressive while maintaining clarity and coherence. There are no academic conventions to follow - let your creativity flow!
+        """
+
+
+class ResearchParameters(BaseModel):
+    breadth: int
+    depth: int
+    explanation: str
+
+
+class FollowUpQuestions(BaseModel):
+    follow_up_queries: list[str]
+
+
+class QueryResponse(BaseModel):
+    queries: list[str]
+
+
+class ProcessedResult(BaseModel):
+    learnings: list[str]
+    follow_up_questions: list[str]
+
+
+class QueryClusters(BaseModel):
+    clusters: list[list[int]]
+
+
+_RESEARCH_PARAMETERS_CONFIG = {
+    "temperature": 0.2,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 1024,
+    "response_mime_type": "application/json",
+    "response_schema": ResearchParameters,
+}
+
+_FOLLOW_UP_QUESTIONS_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 1024,
+    "response_mime_type": "application/json",
+    "response_schema": FollowUpQuestions,
+}
+
+_GENERATE_QUERIES_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 1024,
+    "response_mime_type": "application/json",
+    "response_schema": QueryResponse,
+}
+
+_PROCESS_RESULT_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 2048,
+    "response_mime_type": "application/json",
+    "response_schema": ProcessedResult,
+}
+
+_CLUSTER_QUERIES_CONFIG = {
+    "temperature": 0.2,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 1024,
+    "response_mime_type": "application/json",
+    "response_schema": QueryClusters,
+}
+
+_SEARCH_CONFIG = {
+    "temperature": 1,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+    "response_mime_type": "text/plain",
+    "response_modalities": ["TEXT"],
+    "tools": [types.Tool(google_search=types.GoogleSearch())]
+}
+
+_FINAL_REPORT_CONFIG = {
+    "temperature": 0.9,  # Increased for more creativity
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+}
+
+
 class ResearchProgress:
     def __init__(self, depth: int, breadth: int):
         self.total_depth = depth
@@ -27,58 +234,96 @@ class ResearchProgress:
         self.total_queries = 0  # Total number of queries including sub-queries
         self.completed_queries = 0
         self.query_ids = {}  # Store persistent IDs for queries
+        self._id_rng = random.Random()  # Seeded once from os.urandom, no syscall per ID
         self.root_query = None  # Store the root query
+        self.query_depth = {}  # Map each query to its depth level
+        self.query_children = {}  # Map each query to its sub-queries, in start order
+        self.pending_children = {}  # Number of incomplete sub-queries per query
+        self.report_interval = 0.25  # Minimum seconds between routine progress reports
+        self._last_report = 0.0
+        self._subtree_cache = {}  # Cached tree nodes keyed by query
+        self._dirty = set()  # Queries whose cached subtree must be rebuilt
 
     async def start_query(self, query: str, depth: int, parent_query: str = None):
         """Record the start of a new query"""
-        # Generate a unique ID for this query
-        query_id = str(uuid.uuid4())
-        self.query_ids[query] = query_id
+        # Generate a unique ID for this query, keeping it stable across repeats
+        query_id = self.query_ids.get(query)
+        if query_id is None:
+            query_id = uuid.UUID(int=self._id_rng.getrandbits(128), version=4).hex
+            self.query_ids[query] = query_id
 
         # If this is the first query, set it as the root
         if self.root_query is None:
             self.root_query = query
 
         # Initialize the depth level if it doesn't exist
-        if depth not in self.queries_by_depth:
-            self.queries_by_depth[depth] = {}
+        depth_queries = self.queries_by_depth.setdefault(depth, {})
 
         # Add the query to the appropriate depth level if it's not already there
-        if query not in self.queries_by_depth[depth]:
-            self.queries_by_depth[depth][query] = {
+        if query not in depth_queries:
+            depth_queries[query] = {
                 "completed": False,
-                "learnings": [],
+                "cancelled": False,  # Set when the query was stopped early
+                "learnings": {},  # Insertion-ordered set of learnings
                 "sources": [],  # Add sources list to store source information
-                "id": self.query_ids[query]  # Use persistent ID
+                "id": query_id  # Use persistent ID
             }
             self.query_order.append(query)
+            old_depth = self.query_depth.get(query)
+            self.query_depth[query] = depth
             if parent_query:
+                # A query repeated at another depth moves under its newest parent
+                old_parent = self.query_parents.get(query)
+                if old_parent is not None:
+                    self.query_children[old_parent].remove(query)
+                    if not self.queries_by_depth[old_depth][query]["completed"]:
+                        self.pending_children[old_parent] -= 1
+                    # The old parent's cached subtree still lists this query
+                    self._mark_dirty(old_parent)
                 self.query_parents[query] = parent_query
+                self.query_children.setdefault(parent_query, []).append(query)
+                self.pending_children[parent_query] = self.pending_children.get(
+                    parent_query, 0) + 1
             self.total_queries += 1
+            self._mark_dirty(query)
 
         self.current_depth = depth
-        self.current_breadth = len(self.queries_by_depth[depth])
+        self.current_breadth = len(depth_queries)
         await self._report_progress("query_started")
 
     async def add_learning(self, query: str, depth: int, learning: str):
         if depth in self.queries_by_depth and query in self.queries_by_depth[depth]:
-            self.queries_by_depth[depth][query]["learnings"].append(
-                learning)
-            await self._report_progress("learning_added")
-
-    async def complete_query(self, query: str, depth: int):
-        """Mark a query as completed"""
+            learnings = self.queries_by_depth[depth][query]["learnings"]
+            if learning not in learnings:
+                learnings[learning] = None
+                self._mark_dirty(query)
+                await self._report_progress("learning_added")
+
+    async def complete_query(self, query: str, depth: int, cancelled: bool = False):
+        """Mark a query as completed, or as cancelled if it was stopped early"""
         if depth in self.queries_by_depth and query in self.queries_by_depth[depth]:
             if not self.queries_by_depth[depth][query]["completed"]:
                 self.queries_by_depth[depth][query]["completed"] = True
+                self.queries_by_depth[depth][query]["cancelled"] = cancelled
                 self.completed_queries += 1
-                await self._report_progress(f"Completed query: {query}")
+                self._mark_dirty(query)
+                if cancelled:
+                    await self._report_progress(f"Cancelled query: {query}")
+                else:
+                    await self._report_progress(f"Completed query: {query}")
 
                 # Check if parent query exists and update its status if all children are complete
                 parent_query = self.query_parents.get(query)
-                if parent_query:
+                if parent_query and self.query_depth.get(query) == depth:
                     await self._update_parent_status(parent_query)
 
+            elif cancelled and not self.queries_by_depth[depth][query]["cancelled"]:
+                # Already auto-completed by its cancelled sub-queries, but the query
+                # itself was stopped early too
+                self.queries_by_depth[depth][query]["cancelled"] = True
+                self._mark_dirty(query)
+                await self._report_progress(f"Cancelled query: {query}")
+
     async def add_sources(self, query: str, depth: int, sources: list[dict[str, str]]):
         """Record sources for a specific query"""
         if depth in self.queries_by_depth and query in self.queries_by_depth[depth]:
@@ -91,32 +336,36 @@ class ResearchProgress:
                     current_sources.append(source)
                     current_urls.add(source["url"])
 
+            self._mark_dirty(query)
             await self._report_progress(f"Added sources for query: {query}")
 
+    def _mark_dirty(self, query: str):
+        """Invalidate the cached subtree of a query and all of its ancestors"""
+        # Always walk the whole chain: a dirty query may have been re-parented under
+        # a clean ancestor, so stopping at the first dirty query is not safe
+        seen = set()  # Guards against parent cycles between repeated queries
+        while query is not None and query not in seen:
+            seen.add(query)
+            self._dirty.add(query)
+            query = self.query_parents.get(query)
+
     async def _update_parent_status(self, parent_query: str):
-        """Update parent query status based on children completion"""
-        # Find all children of this parent
-        children = [q for q, p in self.query_parents.items() if p ==
-                    parent_query]
-
-        # Check if all children are complete
-        parent_depth = next((d for d, queries in self.queries_by_depth.items()
-                             if parent_query in queries), None)
-
-        if parent_depth is not None:
-            all_children_complete = all(
-                self.queries_by_depth[d][q]["completed"]
-                for q in children
-                for d in self.queries_by_depth
-                if q in self.queries_by_depth[d]
-            )
+        """Record a completed child and complete the parent once no children are pending"""
+        self.pending_children[parent_query] -= 1
 
-            if all_children_complete:
-                # Complete the parent query
-                await self.complete_query(parent_query, parent_depth)
+        parent_depth = self.query_depth.get(parent_query)
+        if parent_depth is not None and self.pending_children[parent_query] == 0:
+            # Complete the parent query
+            await self.complete_query(parent_query, parent_depth)
 
     async def _report_progress(self, action: str):
         """Report current progress and stream to client if callback provided"""
+        # Coalesce bursts of updates; completed queries are always reported
+        now = time.monotonic()
+        if now - self._last_report < self.report_interval and not action.startswith("Completed query"):
+            return
+        self._last_report = now
+
         # Build event data for streaming
         progress_data = {
             "type": "research_progress",
@@ -127,42 +376,56 @@ class ResearchProgress:
             "progress_percentage": int((self.completed_queries / max(1, self.total_queries)) * 100)
         }
 
-        # Add tree structure if root query exists
-        if self.root_query:
-            progress_data["tree"] = self._build_research_tree()
+        # Print progress to console in a single write
+        sys.stdout.write(
+            f"[Progress] {action}: {progress_data['progress_percentage']}% complete\n")
 
-        # Print progress to console
-        print(
-            f"[Progress] {action}: {progress_data['progress_percentage']}% complete")
+        # Emit the full event with the tree structure if tree reporting is enabled
+        if self.root_query and os.getenv("DEEP_RESEARCH_VERBOSE_TREE") == "1":
+            progress_data["tree"] = self._build_research_tree()
+            sys.stdout.write(orjson.dumps(progress_data).decode() + "\n")
 
     def _build_research_tree(self):
         """Build a tree structure of the research queries"""
-        def build_node(query):
-            """Recursively build the tree node"""
-            # Find the depth for this query
-            depth = next((d for d, queries in self.queries_by_depth.items()
-                          if query in queries), 0)
-
+        if not self.root_query:
+            return {}
+
+        # Iterative post-order walk: children are built before their parents and
+        # clean subtrees are reused from the cache without descending into them
+        stack = [(self.root_query, False)]
+        on_path = set()  # Guards against parent cycles between repeated queries
+        while stack:
+            query, children_built = stack.pop()
+            if query not in self._dirty and query in self._subtree_cache:
+                continue
+
+            children = self.query_children.get(query, [])
+            if not children_built:
+                if query in on_path:
+                    continue
+                on_path.add(query)
+                stack.append((query, True))
+                stack.extend((child, False) for child in reversed(children))
+                continue
+
+            depth = self.query_depth[query]
             data = self.queries_by_depth[depth][query]
-
-            # Find all children of this query
-            children = [q for q, p in self.query_parents.items() if p == query]
-
-            return {
+            self._subtree_cache[query] = {
                 "query": query,
                 "id": self.query_ids[query],
-                "status": "completed" if data["completed"] else "in_progress",
+                "status": ("cancelled" if data["cancelled"] else "completed")
+                if data["completed"] else "in_progress",
                 "depth": depth,
-                "learnings": data["learnings"],
+                "learnings": list(data["learnings"]),
                 "sources": data["sources"],  # Include sources in the tree
-                "sub_queries": [build_node(child) for child in children],
+                "sub_queries": [self._subtree_cache[child] for child in children
+                                if child in self._subtree_cache],
                 "parent_query": self.query_parents.get(query)
             }
+            self._dirty.discard(query)
+            on_path.discard(query)
 
-        # Start building from the root query
-        if self.root_query:
-            return build_node(self.root_query)
-        return {}
+        return self._subtree_cache[self.root_query]
 
     def get_learnings_by_query(self):
         """Get all learnings organized by query"""
@@ -170,67 +433,260 @@ class ResearchProgress:
         for depth, queries in self.queries_by_depth.items():
             for query, data in queries.items():
                 if data["learnings"]:
-                    learnings[query] = data["learnings"]
+                    learnings[query] = list(data["learnings"])
         return learnings
 
 
+_PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+
+
+def _normalize_query(query: str) -> str:
+    """Lowercase a query and strip punctuation for cheap exact comparisons"""
+    return " ".join(query.lower().translate(_PUNCTUATION_TABLE).split())
+
+
+def _set_jaccard(sa: frozenset, sb: frozenset) -> float:
+    """Jaccard similarity of two sets"""
+    return len(sa & sb) / max(1, len(sa | sb))
+
+
+def _jaccard(a: str, b: str) -> float:
+    """Token-set Jaccard similarity of two queries"""
+    return _set_jaccard(frozenset(_normalize_query(a).split()),
+                        frozenset(_normalize_query(b).split()))
+
+
+@functools.lru_cache(maxsize=4096)
+def _shingles(query: str, size: int = 3) -> frozenset:
+    """Character shingles of a normalized query"""
+    text = _normalize_query(query)
+    if len(text) <= size:
+        return frozenset((text,))
+    return frozenset(text[i:i + size] for i in range(len(text) - size + 1))
+
+
+class UrlStore:
+    """Sources collected during a research run, numbered in discovery order and unique by link"""
+
+    def __init__(self, initial=()):
+        self.urls = {}  # Source index -> url data
+        self._links = set()
+        for url_data in initial:
+            self.add(url_data)
+
+    def add(self, url_data: dict):
+        """Add a source unless its link has already been recorded"""
+        if url_data['link'] not in self._links:
+            self._links.add(url_data['link'])
+            self.urls[len(self.urls)] = url_data
+
+
+class CachedResponse:
+    """Minimal stand-in for a Gemini response restored from the on-disk cache"""
+
+    def __init__(self, text: str, schema):
+        self.text = text
+        self._schema = schema
+
+    @property
+    def parsed(self):
+        return self._schema.model_validate_json(self.text)
+
+
 load_dotenv()
 
 
 class DeepSearch:
-    def __init__(self, api_key: str, mode: str = "balanced"):
+    def __init__(self, api_key: str, mode: str = "balanced", max_concurrency: int = None,
+                 cache_path: str = ".gemini_cache.sqlite", max_retries: int = 5,
+                 cache_ttl: float = 7 * 24 * 3600, memory_cache_size: int = 4096):
         """
         Initialize DeepSearch with a mode parameter:
         - "fast": Prioritizes speed (reduced breadth/depth, highest concurrency)
         - "balanced": Default balance of speed and comprehensiveness
         - "comprehensive": Maximum detail and coverage
+
+        max_concurrency caps the number of Gemini calls in flight at once (defaults per mode).
+        max_retries bounds the attempts made for a call that keeps getting rate limited.
+        cache_path is the SQLite file used to cache structured responses (None disables it).
+        cache_ttl is how many seconds a cached response stays valid (None keeps it forever).
+        memory_cache_size bounds the in-memory LRU kept in front of the on-disk cache.
         """
         self.api_key = api_key
         self.model_name = "gemini-2.0-flash"
+        self.embedding_model = "text-embedding-004"
         self.query_history = set()
         self.mode = mode
         self.client = genai.Client(api_key=self.api_key)
-
-    def determine_research_breadth_and_depth(self, query: str):
-        """Determine the appropriate research breadth and depth based on the query complexity"""
-        class ResearchParameters(BaseModel):
-            breadth: int
-            depth: int
-            explanation: str
-
-        user_prompt = f"""
-        Analyze this research query and determine the appropriate breadth (number of parallel search queries) 
-        and depth (levels of follow-up questions) needed for thorough research:
-
-        Query: {query}
-
-        Consider:
-        1. Complexity of the topic
-        2. Breadth of knowledge required
-        3. Depth of expertise needed
-        4. Potential for follow-up exploration
-
-        Return a JSON object with:
-        - "breadth": integer between 1-10 (number of parallel search queries)
-        - "depth": integer between 1-5 (levels of follow-up questions)
-        - "explanation": brief explanation of your reasoning
+        self.max_concurrency = max_concurrency or {
+            "fast": 10,
+            "balanced": 6,
+            "comprehensive": 4
+        }.get(mode, 6)
+        self.max_parallel_queries = {
+            "fast": 8,
+            "balanced": 5,
+            "comprehensive": 3
+        }.get(mode, 5)
+        self.max_retries = max_retries
+        self._sem = None
+        self._sem_loop = None
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        self._cache = None
+        self.memory_cache_size = memory_cache_size
+        self._memory_cache = OrderedDict()  # key -> (response text, created_at), LRU order
+        self._config_cache = {}  # Validated generation configs keyed by their contents
+        self._schema_json_cache = {}  # JSON schema of each response schema class
+        self._embedding_cache = {}  # Unit-length query embeddings keyed by query text
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """Return the concurrency semaphore for the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._sem is None or self._sem_loop is not loop:
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+            self._sem_loop = loop
+        return self._sem
+
+    @staticmethod
+    def _config_value_key(value):
+        """Turn a generation config value into a hashable key"""
+        # Response schemas are module-level classes, so they hash by identity
+        if isinstance(value, list):
+            return tuple(repr(item) for item in value)
+        return value
+
+    def _get_generation_config(self, config: dict) -> types.GenerateContentConfig:
+        """Return a validated GenerateContentConfig, reusing one built for an identical config"""
+        key = tuple(sorted((k, self._config_value_key(v)) for k, v in config.items()))
+        generation_config = self._config_cache.get(key)
+        if generation_config is None:
+            generation_config = types.GenerateContentConfig(**config)
+            self._config_cache[key] = generation_config
+        return generation_config
+
+    @staticmethod
+    def _retry_delay(error: errors.APIError):
+        """Return the retry delay in seconds suggested by a rate-limit error, if any"""
+        details = error.details
+        if not isinstance(details, dict):
+            return None
+        details = details.get("error", details)
+        for detail in details.get("details") or []:
+            delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+            if isinstance(delay, str) and delay.endswith("s"):
+                try:
+                    return float(delay[:-1])
+                except ValueError:
+                    continue
+        return None
+
+    async def _generate_content(self, contents: str, config: dict):
+        """
+        Call the Gemini model asynchronously, bounded by the concurrency limit.
+        Rate-limited (429) calls are retried with jittered exponential backoff.
         """
+        generation_config = self._get_generation_config(config)
+        for attempt in range(self.max_retries):
+            async with self._get_semaphore():
+                try:
+                    return await self.client.aio.models.generate_content(
+                        model=self.model_name,
+                        contents=contents,
+                        config=generation_config
+                    )
+                except errors.APIError as e:
+                    if e.code != 429 or attempt == self.max_retries - 1:
+                        raise
+                    retry_delay = self._retry_delay(e)
+
+            # Back off with jitter outside the semaphore so the slot is released while waiting,
+            # honouring the delay the server asked for when it sent one
+            if retry_delay is not None:
+                delay = retry_delay + random.uniform(0.0, 1.0)
+            else:
+                delay = random.uniform(0.5, 1.0) * 2 ** attempt
+            print(f"Rate limited by Gemini, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    def _get_cache(self) -> sqlite3.Connection:
+        """Open the response cache on first use"""
+        if self._cache is None:
+            self._cache = sqlite3.connect(self.cache_path)
+            self._cache.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)")
+        return self._cache
+
+    def _cache_key(self, contents: str, config: dict) -> str:
+        """Hash the prompt, model and generation config into a stable cache key"""
+        schema = config.get("response_schema")
+        config_key = {k: v for k, v in config.items() if k != "response_schema"}
+        if schema is not None:
+            # Generating a JSON schema is far costlier than hashing, so do it once per class
+            schema_json = self._schema_json_cache.get(schema)
+            if schema_json is None:
+                schema_json = self._schema_json_cache[schema] = schema.model_json_schema()
+            config_key["response_schema"] = schema_json
+        payload = orjson.dumps([self.model_name, contents, config_key], option=orjson.OPT_SORT_KEYS)
+        return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+    def _is_fresh(self, created_at: float) -> bool:
+        """Whether a cache entry created at `created_at` is still within cache_ttl"""
+        return self.cache_ttl is None or time.time() - created_at < self.cache_ttl
+
+    def _remember(self, key: str, text: str, created_at: float):
+        """Store a response in the in-memory LRU, evicting the oldest entries"""
+        self._memory_cache[key] = (text, created_at)
+        self._memory_cache.move_to_end(key)
+        while len(self._memory_cache) > self.memory_cache_size:
+            self._memory_cache.popitem(last=False)
+
+    async def _cached_generate_content(self, contents: str, config: dict):
+        """
+        Like _generate_content, but serves structured responses from the cache.
+        Hits are looked up in an in-memory LRU first, then in the on-disk cache.
+        Only responses that parse against the config's response_schema are stored,
+        and entries older than cache_ttl are treated as misses.
+        """
+        if self.cache_path is None and not self.memory_cache_size:
+            return await self._generate_content(contents, config)
+
+        key = self._cache_key(contents, config)
+        entry = self._memory_cache.get(key)
+        if entry is not None and self._is_fresh(entry[1]):
+            self._memory_cache.move_to_end(key)
+            return CachedResponse(entry[0], config["response_schema"])
+
+        if self.cache_path is not None:
+            row = self._get_cache().execute(
+                "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and self._is_fresh(row[1]):
+                self._remember(key, row[0], row[1])
+                return CachedResponse(row[0], config["response_schema"])
+
+        response = await self._generate_content(contents, config)
+        try:
+            if response.parsed is not None:
+                created_at = time.time()
+                self._remember(key, response.text, created_at)
+                if self.cache_path is not None:
+                    with self._get_cache() as cache:
+                        cache.execute(
+                            "INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)",
+                            (key, response.text, created_at))
+        except Exception as e:
+            print(f"Error caching response: {str(e)}")
+        return response
 
-        generation_config = {
-            "temperature": 0.2,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 1024,
-            "response_mime_type": "application/json",
-            "response_schema": ResearchParameters,
-        }
+    async def determine_research_breadth_and_depth(self, query: str):
+        """Determine the appropriate research breadth and depth based on the query complexity"""
+        user_prompt = _PROMPT_RESEARCH_PARAMETERS.format(
+            query=query
+        )
 
         try:
-            response = self.client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=user_prompt,
-                config=generation_config
-            )
+            response = await self._cached_generate_content(user_prompt, _RESEARCH_PARAMETERS_CONFIG)
 
             # Get the parsed response using the Pydantic model
             parsed_response = response.parsed
@@ -251,69 +707,44 @@ class DeepSearch:
             }
             return defaults.get(self.mode, {"breadth": 5, "depth": 2, "explanation": "Using default values."})
 
-    def generate_follow_up_questions(
+    async def _generate_list(self, prompt: str, config: dict, key: str, line_filter, cached: bool = False) -> list[str]:
+        """
+        Request a JSON object holding a list of strings under `key` and return that list.
+        If the response cannot be parsed, fall back to the non-empty response lines
+        accepted by `line_filter`. Errors from the API call itself are raised.
+        """
+        generate = self._cached_generate_content if cached else self._generate_content
+        response = await generate(prompt, config)
+
+        try:
+            # Get the parsed response using the Pydantic model
+            return list(getattr(response.parsed, key))
+        except Exception as e:
+            print(f"Error parsing {key} response: {str(e)}")
+            # Fallback to simple text parsing
+            lines = (line.strip() for line in response.text.strip().split('\n'))
+            return [line for line in lines if line and line_filter(line)]
+
+    async def generate_follow_up_questions(
         self,
         query: str,
         max_questions: int = 3,
     ):
         """Generate follow-up questions based on the initial query"""
-        class FollowUpQuestions(BaseModel):
-            follow_up_queries: list[str]
-
-        user_prompt = f"""
-        Based on the following user query, generate {max_questions} follow-up questions that would help clarify what the user wants to know.
-		These questions should:
-		1. Seek to understand the user's specific information needs
-		2. Clarify ambiguous terms or concepts in the original query
-		3. Determine the scope or boundaries of what the user is looking for
-		4. Identify the user's level of familiarity with the topic
-		5. Uncover the user's purpose or goal for seeking this information
-
-		User Query: {query}
-
-		Format your response as a JSON object with a single key "follow_up_queries" containing an array of strings.
-		Example:
-		```json
-		{{
-			"follow_up_queries": [
-				"Could you specify what aspects of electric vehicles you're most interested in learning about?",
-				"Are you looking for information about a specific brand or type of electric vehicle?",
-				"Would you like to know about the technical details, environmental impact, or consumer aspects?"
-			]
-		}}
-		```
-        """
-
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 1024,
-            "response_mime_type": "application/json",
-            "response_schema": FollowUpQuestions,
-        }
+        user_prompt = _PROMPT_FOLLOW_UP_QUESTIONS.format(
+            max_questions=max_questions,
+            query=query
+        )
 
         try:
-            response = self.client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=user_prompt,
-                config=generation_config
+            questions = await self._generate_list(
+                user_prompt,
+                _FOLLOW_UP_QUESTIONS_CONFIG,
+                "follow_up_queries",
+                line_filter=lambda line: '?' in line,
+                cached=True
             )
-
-            try:
-                # Get the parsed response using the Pydantic model
-                parsed_response = response.parsed
-                return parsed_response.follow_up_queries
-            except Exception as e:
-                print(f"Error parsing follow-up questions: {str(e)}")
-                # Fallback to simple text parsing
-                lines = response.text.strip().split('\n')
-                questions = []
-                for line in lines:
-                    line = line.strip()
-                    if line and '?' in line:
-                        questions.append(line)
-                return questions[:max_questions]
+            return questions[:max_questions]
 
         except Exception as e:
             print(f"Error generating follow-up questions: {str(e)}")
@@ -323,10 +754,12 @@ class DeepSearch:
             self,
             query: str,
             num_queries: int = 3,
-            learnings: list[str] = [],
+            learnings: list[str] = None,
             previous_queries: set[str] = None  # Add previous_queries parameter
     ):
         """Generate search queries based on the initial query and learnings"""
+        if learnings is None:
+            learnings = []
         if previous_queries is None:
             previous_queries = set()
 
@@ -340,75 +773,33 @@ class DeepSearch:
         mode_prompt = prompt_by_mode.get(self.mode, prompt_by_mode["balanced"])
 
         # Format learnings for the prompt
-        learnings_text = "\n".join([f"- {learning}" for learning in learnings])
+        learnings_text = "\n".join(f"- {learning}" for learning in learnings)
         learnings_section = f"\nBased on what we've learned so far:\n{learnings_text}" if learnings else ""
 
         # Format previous queries for the prompt
-        previous_queries_text = "\n".join([f"- {q}" for q in previous_queries])
+        # Sort the set so the prompt, and so its cache key, is stable across runs
+        previous_queries_text = "\n".join(f"- {q}" for q in sorted(previous_queries))
         previous_queries_section = f"\nPrevious search queries (avoid repeating these):\n{previous_queries_text}" if previous_queries else ""
 
-        user_prompt = f"""
-        You are a research assistant helping to explore the topic: "{query}"
-        
-        {mode_prompt}.
-        {learnings_section}
-        {previous_queries_section}
-        
-        Generate {num_queries} specific search queries that would help gather comprehensive information about this topic.
-        Each query should focus on a different aspect or subtopic.
-        Make the queries specific and well-formed for a search engine.
-        
-        Format your response as a JSON object with a "queries" field containing an array of query strings.
-        """
-
-        class QueryResponse(BaseModel):
-            queries: list[str]
-
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 1024,
-            "response_mime_type": "application/json",
-            "response_schema": QueryResponse,
-        }
+        user_prompt = _PROMPT_GENERATE_QUERIES.format(
+            query=query,
+            mode_prompt=mode_prompt,
+            learnings_section=learnings_section,
+            previous_queries_section=previous_queries_section,
+            num_queries=num_queries
+        )
 
         try:
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=user_prompt,
-                config=generation_config
-            )
-
-            # Parse the response
-            try:
-                # Get the parsed response using the Pydantic model
-                parsed_response = response.parsed
-                queries = set(parsed_response.queries)
-
-                # Filter out any queries that are too similar to previous ones
-                unique_queries = set()
-                for q in queries:
-                    is_similar = False
-                    for prev_q in previous_queries:
-                        if await self._are_queries_similar(q, prev_q):
-                            is_similar = True
-                            break
+            queries = set(await self._generate_list(
+                user_prompt,
+                _GENERATE_QUERIES_CONFIG,
+                "queries",
+                line_filter=lambda line: not line.startswith(('{', '}')),
+                cached=True
+            ))
 
-                    if not is_similar:
-                        unique_queries.add(q)
-
-                return unique_queries
-            except Exception as e:
-                print(f"Error parsing query response: {str(e)}")
-                # Fallback to simple text parsing if JSON parsing fails
-                lines = response.text.strip().split('\n')
-                queries = set()
-                for line in lines:
-                    line = line.strip()
-                    if line and not line.startswith('{') and not line.startswith('}'):
-                        queries.add(line)
-                return queries
+            # Filter out any queries that are too similar to previous ones
+            return await self._filter_similar_queries(queries, previous_queries)
 
         except Exception as e:
             print(f"Error generating queries: {str(e)}")
@@ -440,11 +831,11 @@ class DeepSearch:
             # Create mapping of URLs
             sources = {
                 i: {
-                    'link': chunk.get('web', {}).get('uri', ''),
-                    'title': chunk.get('web', {}).get('title', '')
+                    'link': web.get('uri', ''),
+                    'title': web.get('title', '')
                 }
                 for i, chunk in enumerate(grounding_chunks)
-                if chunk.get('web')
+                if (web := chunk.get('web'))
             }
 
             # Create a list of (position, citation) tuples
@@ -456,52 +847,33 @@ class DeepSearch:
                 if indices and segment and segment.get('end_index') is not None:
                     end_index = segment['end_index']
                     source_idx = indices[0]
-                    if source_idx in sources:
-                        citation = f"[[{source_idx + 1}]]({sources[source_idx]['link']})"
+                    source = sources.get(source_idx)
+                    if source is not None:
+                        citation = f"[[{source_idx + 1}]]({source['link']})"
                         citations.append((end_index, citation))
 
             # Sort citations by position (end_index)
-            citations.sort(key=lambda x: x[0])
+            citations.sort(key=itemgetter(0))
 
-            # Insert citations into the text
-            result = ""
+            # Insert citations into the text, joining all slices in one pass
+            parts = []
             last_pos = 0
             for pos, citation in citations:
-                result += answer[last_pos:pos]
-                result += citation
+                parts.append(answer[last_pos:pos])
+                parts.append(citation)
                 last_pos = pos
 
             # Add any remaining text
-            result += answer[last_pos:]
+            parts.append(answer[last_pos:])
 
-            return result, sources
+            return "".join(parts), sources
 
         except Exception as e:
             print(f"Error processing grounding metadata: {e}")
             return answer, {}
 
     async def search(self, query: str):
-        model_id = "gemini-2.0-flash"
-
-        google_search_tool = types.Tool(
-            google_search=types.GoogleSearch()
-        )
-
-        generation_config = {
-            "temperature": 1,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 8192,
-            "response_mime_type": "text/plain",
-            "response_modalities": ["TEXT"],
-            "tools": [google_search_tool]
-        }
-
-        response = await self.client.aio.models.generate_content(
-            model=model_id,
-            contents=query,
-            config=generation_config
-        )
+        response = await self._generate_content(query, _SEARCH_CONFIG)
 
         response_dict = response.model_dump()
 
@@ -518,40 +890,15 @@ class DeepSearch:
         num_follow_up_questions: int = 3,
     ):
         """Process search results to extract learnings and generate follow-up questions"""
-        class ProcessedResult(BaseModel):
-            learnings: list[str]
-            follow_up_questions: list[str]
-
-        user_prompt = f"""
-        Analyze the following search results for the query: "{query}"
-        
-        Search Results:
-        {result}
-        
-        Please extract:
-        1. The {num_learnings} most important learnings or insights from these results
-        2. {num_follow_up_questions} follow-up questions that would help explore this topic further
-        
-        Format your response as a JSON object with:
-        - "learnings": array of learning strings
-        - "follow_up_questions": array of question strings
-        """
-
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 2048,
-            "response_mime_type": "application/json",
-            "response_schema": ProcessedResult,
-        }
+        user_prompt = _PROMPT_PROCESS_RESULT.format(
+            query=query,
+            result=result,
+            num_learnings=num_learnings,
+            num_follow_up_questions=num_follow_up_questions
+        )
 
         try:
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=user_prompt,
-                config=generation_config
-            )
+            response = await self._cached_generate_content(user_prompt, _PROCESS_RESULT_CONFIG)
 
             try:
                 # Get the parsed response using the Pydantic model
@@ -563,7 +910,7 @@ class DeepSearch:
             except Exception as e:
                 print(f"Error parsing process_result: {str(e)}")
                 # Fallback to generating follow-up questions separately
-                follow_up_questions = self.generate_follow_up_questions(
+                follow_up_questions = await self.generate_follow_up_questions(
                     query, num_follow_up_questions
                 )
 
@@ -585,55 +932,184 @@ class DeepSearch:
                 "follow_up_questions": [f"What are the key aspects of {query}?"]
             }
 
+    async def cluster_similar_queries(self, queries: list[str]) -> list[list[int]]:
+        """
+        Group semantically similar queries with a single Gemini call.
+        Returns a list of clusters, each a list of indices into `queries`.
+        Every index appears in exactly one cluster.
+        """
+        if len(queries) < 2:
+            return [[i] for i in range(len(queries))]
+
+        queries_text = "\n".join(f"{i}. {q}" for i, q in enumerate(queries))
+
+        user_prompt = _PROMPT_CLUSTER_QUERIES.format(
+            queries_text=queries_text
+        )
+
+        try:
+            response = await self._cached_generate_content(user_prompt, _CLUSTER_QUERIES_CONFIG)
+
+            # Get the parsed response using the Pydantic model
+            parsed_response = response.parsed
+            raw_clusters = parsed_response.clusters
+        except Exception as e:
+            print(f"Error clustering queries: {str(e)}")
+            # In case of error, assume queries are different to avoid missing potentially unique results
+            raw_clusters = []
+
+        # Drop invalid or repeated indices and give unassigned queries their own cluster
+        clusters = []
+        assigned = set()
+        for raw_cluster in raw_clusters:
+            cluster = []
+            for idx in raw_cluster:
+                idx = int(idx)
+                if 0 <= idx < len(queries) and idx not in assigned:
+                    cluster.append(idx)
+                    assigned.add(idx)
+            if cluster:
+                clusters.append(cluster)
+        clusters.extend([i] for i in range(len(queries)) if i not in assigned)
+        return clusters
+
+    async def _filter_similar_queries(self, queries: set[str], previous_queries: set[str]) -> set[str]:
+        """
+        Drop queries similar to previous ones, keeping one representative per cluster.
+        Token overlap settles clear-cut cases; only borderline candidates, with the
+        previous queries they overlap, are clustered by Gemini.
+        """
+        previous_normalized = {_normalize_query(q) for q in previous_queries}
+        candidates = {}  # Candidate query -> its token set
+        # Iterate the sets in sorted order so the clustering prompt is stable across runs
+        for q in sorted(queries):
+            normalized = _normalize_query(q)
+            if normalized not in previous_normalized:
+                previous_normalized.add(normalized)
+                candidates[q] = frozenset(normalized.split())
+        if not previous_queries or not candidates:
+            return set(candidates)
+
+        previous_tokens = {q: frozenset(_normalize_query(q).split()) for q in sorted(previous_queries)}
+        unique_queries = set()
+        borderline = []
+        for q, tokens in candidates.items():
+            history_overlap = max(
+                (_set_jaccard(tokens, other) for other in previous_tokens.values()), default=0.0)
+            if history_overlap >= 0.85:
+                continue
+            batch_overlap = max(
+                (_set_jaccard(tokens, other) for c, other in candidates.items() if c != q),
+                default=0.0)
+            if max(history_overlap, batch_overlap) <= 0.15:
+                unique_queries.add(q)
+            else:
+                borderline.append(q)
+
+        if not borderline:
+            return unique_queries
+
+        # Only previous queries sharing tokens with a borderline candidate can cluster with it
+        previous = [
+            q for q, tokens in previous_tokens.items()
+            if any(_set_jaccard(tokens, candidates[c]) > 0.15 for c in borderline)
+        ]
+        clusters = await self.cluster_similar_queries(previous + borderline)
+
+        for cluster in clusters:
+            # Skip clusters that overlap with a query we have already searched
+            if any(idx < len(previous) for idx in cluster):
+                continue
+            unique_queries.add(borderline[cluster[0] - len(previous)])
+        return unique_queries
+
     async def _are_queries_similar(self, query1: str, query2: str) -> bool:
         """Check if two queries are semantically similar"""
         # Simple string comparison for exact matches
-        if query1.lower() == query2.lower():
+        if _normalize_query(query1) == _normalize_query(query2):
             return True
 
         # For very short queries, use substring check
         if len(query1) < 10 or len(query2) < 10:
             return query1.lower() in query2.lower() or query2.lower() in query1.lower()
 
-        # For more complex queries, use Gemini to check similarity
-        class SimilarityResult(BaseModel):
-            are_similar: bool
-
-        user_prompt = f"""
-        Compare these two search queries and determine if they are semantically similar 
-        (would likely return similar search results):
-        
-        Query 1: {query1}
-        Query 2: {query2}
-        
-        Return a JSON object with a single boolean field "are_similar" indicating if the queries are similar.
-        """
+        # Settle clear-cut pairs on token overlap before asking Gemini
+        overlap = _jaccard(query1, query2)
+        if overlap >= 0.85:
+            return True
+        if overlap <= 0.15:
+            return False
 
-        generation_config = {
-            "temperature": 0.2,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 1024,
-            "response_mime_type": "application/json",
-            "response_schema": SimilarityResult,
-        }
+        # For borderline queries, use the batched Gemini clustering
+        clusters = await self.cluster_similar_queries([query1, query2])
+        return any(len(cluster) > 1 for cluster in clusters)
+
+    async def _embed_queries(self, queries: list[str], batch_size: int = 32) -> list[list[float]]:
+        """Return unit-length embeddings for `queries`, embedding uncached ones in batches"""
+        missing = [q for q in dict.fromkeys(queries) if q not in self._embedding_cache]
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            async with self._get_semaphore():
+                response = await self.client.aio.models.embed_content(
+                    model=self.embedding_model,
+                    contents=batch
+                )
+            for q, embedding in zip(batch, response.embeddings):
+                norm = math.sqrt(sum(v * v for v in embedding.values)) or 1.0
+                self._embedding_cache[q] = [v / norm for v in embedding.values]
+        return [self._embedding_cache[q] for q in queries]
 
-        try:
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=user_prompt,
-                config=generation_config
+    async def _filter_similar_to_history(self, queries: list[str], threshold: float = 0.85) -> list[str]:
+        """
+        Drop queries that repeat one in the history or one already kept from this batch.
+        Shingle overlap settles clear-cut cases; only borderline queries are compared
+        by embedding, and dropped when within `threshold` cosine similarity.
+        """
+        history_shingles = [_shingles(q) for q in self.query_history]
+        kept = {}  # Lexically distinct queries -> their shingles
+        borderline = []
+        for q in dict.fromkeys(queries):
+            shingles = _shingles(q)
+            overlap = max(
+                (_set_jaccard(shingles, other)
+                 for other in itertools.chain(history_shingles, kept.values())),
+                default=0.0
             )
+            if overlap > 0.4:
+                continue
+            if overlap < 0.2:
+                kept[q] = shingles
+            else:
+                borderline.append(q)
+
+        if borderline:
+            history = list(self.query_history) + list(kept)
+            try:
+                vectors = await self._embed_queries(history + borderline)
+            except Exception as e:
+                print(f"Error embedding queries: {str(e)}")
+                # In case of error, keep the queries to avoid missing potentially unique results
+                vectors = None
+
+            if vectors is None:
+                kept.update(dict.fromkeys(borderline))
+            else:
+                kept_vectors = vectors[:len(history)]
+                for q, vector in zip(borderline, vectors[len(history):]):
+                    if any(sum(a * b for a, b in zip(vector, other)) > threshold for other in kept_vectors):
+                        continue
+                    kept[q] = None
+                    kept_vectors.append(vector)
+
+        # Keep the caller's order so the most relevant questions stay first
+        return [q for q in dict.fromkeys(queries) if q in kept]
+
+    async def deep_research(self, query: str, breadth: int, depth: int, learnings: list[str] = None, visited_urls: dict[int, dict] = None, parent_query: str = None):
+        if learnings is None:
+            learnings = []
+        if visited_urls is None:
+            visited_urls = {}
 
-            # Get the parsed response using the Pydantic model
-            parsed_response = response.parsed
-            return parsed_response.are_similar
-        except Exception as e:
-            print(f"Error comparing queries: {str(e)}")
-            # In case of error, assume queries are different to avoid missing potentially unique results
-            return False
-
-    async def deep_research(self, query: str, breadth: int, depth: int, learnings: list[str] = [], visited_urls: dict[int, dict] = {}, parent_query: str = None):
         progress = ResearchProgress(depth, breadth)
 
         # Start the root query
@@ -653,44 +1129,66 @@ class DeepSearch:
             previous_queries=self.query_history
         )
 
-        self.query_history.update(queries)
-        unique_queries = list(queries)[:breadth]
+        # Drop queries already researched (case-insensitive) before fanning out
+        seen_lower = {q.strip().lower() for q in self.query_history}
+        unique_queries = []
+        for q in queries:
+            if len(unique_queries) >= breadth:
+                break
+            key = q.strip().lower()
+            if key not in seen_lower:
+                unique_queries.append(q)
+                seen_lower.add(key)
+
+        self.query_history.update(unique_queries)
+
+        query_sem = asyncio.Semaphore(self.max_parallel_queries)
+
+        # One store shared by every branch, so sources are never copied or re-merged
+        url_store = UrlStore(visited_urls.values())
+
+        # Learnings asked of each query; sub-queries stop early once they add twice this many
+        learning_density = min(5, math.ceil(breadth / 1.5))
 
         async def process_query(query_str: str, current_depth: int, parent: str = None):
             try:
                 # Start this query as a sub-query of the parent
                 await progress.start_query(query_str, current_depth, parent)
 
-                result = await self.search(query_str)
-                # The search method returns a tuple (formatted_text, sources)
-                formatted_text, new_urls = result
-
-                # Add sources to the progress tracker for this query
-                if new_urls:
-                    sources_list = [
-                        {"url": url_data["link"], "title": url_data["title"]}
-                        for url_data in new_urls.values()
-                        if "link" in url_data and "title" in url_data
-                    ]
-                    await progress.add_sources(query_str, current_depth, sources_list)
-
-                processed_result = await self.process_result(
-                    query=query_str,
-                    result=formatted_text,
-                    num_learnings=min(5, math.ceil(breadth / 1.5)),
-                    num_follow_up_questions=min(5, math.ceil(breadth / 1.5))
-                )
+                # Bound how many queries are searched and analysed at once; the slot is
+                # released before recursing so parents never block their own sub-queries
+                async with query_sem:
+                    result = await self.search(query_str)
+                    # The search method returns a tuple (formatted_text, sources)
+                    formatted_text, new_urls = result
+
+                    # Add sources to the progress tracker for this query
+                    if new_urls:
+                        sources_list = [
+                            {"url": url_data["link"], "title": url_data["title"]}
+                            for url_data in new_urls.values()
+                            if "link" in url_data and "title" in url_data
+                        ]
+                        await progress.add_sources(query_str, current_depth, sources_list)
+
+                    processed_result = await self.process_result(
+                        query=query_str,
+                        result=formatted_text,
+                        num_learnings=learning_density,
+                        num_follow_up_questions=min(5, math.ceil(breadth / 1.5))
+                    )
 
                 # Record learnings
                 for learning in processed_result["learnings"]:
                     await progress.add_learning(query_str, current_depth, learning)
 
-                new_urls = result[1]
-                max_idx = max(visited_urls.keys()) if visited_urls else -1
-                all_urls = {
-                    **visited_urls,
-                    **{(i + max_idx + 1): url_data for i, url_data in new_urls.items()}
-                }
+                for url_data in new_urls.values():
+                    url_store.add(url_data)
+
+                # This query's learnings followed by those of its finished sub-queries,
+                # so deeper levels reach the final report
+                query_learnings = dict.fromkeys(processed_result["learnings"])
+                own_count = len(query_learnings)
 
                 # Only go deeper if in comprehensive mode and depth > 1
                 if self.mode == "comprehensive" and current_depth > 1:
@@ -701,72 +1199,75 @@ class DeepSearch:
 
                     # Select most important follow-up questions instead of just one
                     if processed_result['follow_up_questions']:
-                        # Take up to 3 most relevant questions instead of just 1
-                        follow_up_questions = processed_result['follow_up_questions'][:3]
-
-                        # Process each sub-query
-                        for next_query in follow_up_questions:
-                            sub_results = await process_query(
+                        # Skip follow-ups that repeat research already done, then
+                        # take up to 3 most relevant questions instead of just 1
+                        follow_up_questions = (await self._filter_similar_to_history(
+                            processed_result['follow_up_questions']
+                        ))[:3]
+                        self.query_history.update(follow_up_questions)
+
+                        # Start every sub-query right away so deeper levels overlap
+                        # with sibling queries that are still in flight
+                        sub_tasks = [
+                            asyncio.create_task(process_query(
                                 next_query,
                                 new_depth,
                                 query_str  # Pass current query as parent
-                            )
-
-                            # Merge the sub-results with the current results
-                            if sub_results:
-                                # Add sub-query learnings to all_urls
-                                if "visited_urls" in sub_results:
-                                    for url_key, url_data in sub_results["visited_urls"].items():
-                                        if url_data['link'] not in [u['link'] for u in all_urls.values()]:
-                                            max_idx = max(
-                                                all_urls.keys()) if all_urls else -1
-                                            all_urls[max_idx + 1] = url_data
+                            ))
+                            for next_query in follow_up_questions
+                        ]
+
+                        # Sub-queries record their sources in the shared store. Stop waiting
+                        # once they have added enough new learnings and cancel the rest
+                        try:
+                            for next_result in asyncio.as_completed(sub_tasks):
+                                sub_results = await next_result
+                                query_learnings.update(dict.fromkeys(sub_results["learnings"]))
+                                if len(query_learnings) - own_count >= 2 * learning_density:
+                                    break
+                        finally:
+                            for task in sub_tasks:
+                                task.cancel()
+                            await asyncio.gather(*sub_tasks, return_exceptions=True)
 
                 await progress.complete_query(query_str, current_depth)
                 return {
-                    "learnings": processed_result["learnings"],
-                    "visited_urls": all_urls
+                    "learnings": list(query_learnings)
                 }
 
+            except asyncio.CancelledError:
+                # Close out branches cut short by an early stop so their parents still complete
+                await progress.complete_query(query_str, current_depth, cancelled=True)
+                raise
+
             except Exception as e:
                 print(f"Error processing query {query_str}: {str(e)}")
                 await progress.complete_query(query_str, current_depth)
                 return {
-                    "learnings": [],
-                    "visited_urls": {}
+                    "learnings": []
                 }
 
         # Process queries concurrently
-        tasks = [process_query(q, depth, query) for q in unique_queries]
+        tasks = [asyncio.create_task(process_query(q, depth, query))
+                 for q in unique_queries]
         results = await asyncio.gather(*tasks)
 
         # Combine results
-        all_learnings = list(set(
-            learning
-            for result in results
-            for learning in result["learnings"]
-        ))
-
-        all_urls = {}
-        current_idx = 0
-        seen_urls = set()
-        for result in results:
-            for url_data in result["visited_urls"].values():
-                if url_data['link'] not in seen_urls:
-                    all_urls[current_idx] = url_data
-                    seen_urls.add(url_data['link'])
-                    current_idx += 1
+        all_learnings = list(dict.fromkeys(itertools.chain.from_iterable(
+            result["learnings"] for result in results
+        )))
+
+        all_urls = url_store.urls
 
         # Complete the root query after all sub-queries are done
         await progress.complete_query(query, depth)
 
-        # Build the research tree
+        # Build the research tree once and reuse it for the file and the result
         research_tree = progress._build_research_tree()
 
         print(f"Research tree built with {len(all_learnings)} learnings")
-        # save the research tree to a file
-        with open("research_tree.json", "w") as f:
-            json.dump(research_tree, f)
+        # save the research tree to a file without blocking the event loop
+        await asyncio.to_thread(Path("research_tree.json").write_bytes, orjson.dumps(research_tree))
 
         return {
             "learnings": all_learnings,
@@ -776,51 +1277,17 @@ class DeepSearch:
 
     async def generate_final_report(self, query: str, learnings: list[str], visited_urls: dict[int, dict]) -> str:
         # Format learnings for the prompt
-        learnings_text = "\n".join([
+        learnings_text = "\n".join(
             f"- {learning}" for learning in learnings
-        ])
-
-        user_prompt = f"""
-		You are a creative storyteller tasked with transforming research into an engaging and distinctive report.
-
-        Research Query: {query}
-
-        Key Discoveries:
-        {learnings_text}
-
-        Craft a captivating report that:
-
-        # CREATIVE APPROACH
-        1. Opens with an imaginative introduction that draws readers into the topic
-        2. Transforms key discoveries into a compelling narrative with your unique voice
-        3. Adds fresh perspectives and unexpected connections between ideas
-        4. Experiments freely with tone, style, and expression
-        5. Concludes with thought-provoking reflections that linger with the reader
-
-        # FORMATTING TOOLS
-        - Create evocative, imaginative headings
-        - Use markdown formatting (##, ###, **bold**, *italics*) for visual interest
-        - Incorporate blockquotes for emphasis or contrast
-        - Deploy bullet points or numbered lists where they enhance clarity
-        - Insert tables to organize information in visually appealing ways
-        - Use horizontal rules (---) to create dramatic pauses or section breaks
-
-        Feel free to be bold, experimental, and expressive while maintaining clarity and coherence. There are no academic conventions to follow - let your creativity flow!
-        """
+        )
 
-        generation_config = {
-            "temperature": 0.9,  # Increased for more creativity
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 8192,
-        }
+        user_prompt = _PROMPT_FINAL_REPORT.format(
+            query=query,
+            learnings_text=learnings_text
+        )
 
         try:
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=user_prompt,
-                config=generation_config
-            )
+            response = await self._generate_content(user_prompt, _FINAL_REPORT_CONFIG)
             return response.text
         except Exception as e:
             print(f"Error generating final report: {str(e)}")
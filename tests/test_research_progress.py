@@ -0,0 +1,71 @@
+import unittest
+
+from src.deep_research import ResearchProgress
+
+
+def _sub_queries(node):
+    return [child["query"] for child in node["sub_queries"]]
+
+
+def _find(node, query):
+    if node["query"] == query:
+        return node
+    for child in node["sub_queries"]:
+        found = _find(child, query)
+        if found is not None:
+            return found
+    return None
+
+
+class ResearchTreeReparentTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.progress = ResearchProgress(depth=3, breadth=2)
+        await self.progress.start_query("root", 3)
+        await self.progress.start_query("A", 3, "root")
+        await self.progress.start_query("B", 3, "root")
+        await self.progress.start_query("X", 2, "A")
+
+    async def test_reparent_after_build(self):
+        tree = self.progress._build_research_tree()
+        self.assertEqual(_sub_queries(_find(tree, "A")), ["X"])
+
+        # X repeated at another depth moves under B
+        await self.progress.start_query("X", 1, "B")
+        tree = self.progress._build_research_tree()
+
+        self.assertEqual(_sub_queries(_find(tree, "A")), [])
+        self.assertEqual(_sub_queries(_find(tree, "B")), ["X"])
+
+    async def test_reparent_while_dirty(self):
+        self.progress._build_research_tree()
+        await self.progress.add_learning("X", 2, "a learning")
+
+        await self.progress.start_query("X", 1, "B")
+        tree = self.progress._build_research_tree()
+
+        self.assertEqual(_sub_queries(_find(tree, "A")), [])
+        self.assertEqual(_sub_queries(_find(tree, "B")), ["X"])
+
+
+class ResearchTreeCancelTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cancelled_parent_with_sub_queries_in_flight(self):
+        progress = ResearchProgress(depth=3, breadth=2)
+        await progress.start_query("root", 3)
+        await progress.start_query("P", 3, "root")
+        await progress.start_query("C1", 2, "P")
+        await progress.start_query("C2", 2, "P")
+
+        # Cancelling P first cancels its sub-queries, which auto-completes P
+        await progress.complete_query("C1", 2, cancelled=True)
+        await progress.complete_query("C2", 2, cancelled=True)
+        await progress.complete_query("P", 3, cancelled=True)
+
+        tree = progress._build_research_tree()
+        self.assertEqual(_find(tree, "P")["status"], "cancelled")
+        self.assertEqual(_find(tree, "C1")["status"], "cancelled")
+        # P finishing also completes root; P itself is not counted twice
+        self.assertEqual(progress.completed_queries, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()